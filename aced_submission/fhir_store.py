@@ -4,11 +4,13 @@ import pathlib
 import sys
 
 import click
+import orjson
 import yaml
 from elasticsearch import Elasticsearch
 
 from aced_submission import NaturalOrderGroup
-from aced_submission.meta_flat_load import read_ndjson, write_bulk_http, DEFAULT_ELASTIC
+from aced_submission.meta_flat_load import write_bulk_http, bulk_load_settings, DEFAULT_ELASTIC
+from aced_submission.util import read_ndjson
 
 
 @click.group(cls=NaturalOrderGroup, name='fhir')
@@ -22,28 +24,31 @@ def resource_generator(project_id, file_path):
     program, project = project_id.split('-')
     assert program, "program is required"
     assert project, "project is required"
+    auth_resource_path = f"/programs/{program}/projects/{project}"
 
     for _ in read_ndjson(file_path):
         assert 'id' in _, f"resource {_} does not have an 'id'"
         assert 'resourceType' in _, f"resource {_} does not have a 'resourceType'"
-        _["auth_resource_path"] = f"/programs/{program}/projects/{project}"
+        _["auth_resource_path"] = auth_resource_path
         yield _
 
+
 def fhir_put(project_id, path, elastic_url) -> list[str]:
     """Upsert FHIR resources to a FHIR store."""
     assert project_id.count('-') == 1, f"{project_id} should have a single '-' separating program and project"
 
     elastic = Elasticsearch([elastic_url], request_timeout=120)
 
-    index = doc_type ='fhir'
+    index = doc_type = 'fhir'
     limit = None
     logs = []
-    for file_path in pathlib.Path(path).glob('*.ndjson'):
+    with bulk_load_settings(elastic, index):
+        for file_path in pathlib.Path(path).glob('*.ndjson'):
 
-        write_bulk_http(elastic=elastic, index=index, doc_type=doc_type, limit=limit,
-                        generator=resource_generator(project_id, file_path), schema=None)
+            write_bulk_http(elastic=elastic, index=index, doc_type=doc_type, limit=limit,
+                            generator=resource_generator(project_id, file_path), schema=None)
 
-        logs.append(f"wrote {file_path} to {elastic_url}/{index}")
+            logs.append(f"wrote {file_path} to {elastic_url}/{index}")
 
     return logs
 
@@ -67,9 +72,9 @@ def fhir_get(project_id, path, elastic_url) -> list[str]:
 
     def _emitter(_resource_type):
         """Maintain has of open files."""
-        if resource_type not in emitters:
+        if _resource_type not in emitters:
             file_path = pathlib.Path(path) / f"{_resource_type}.ndjson"
-            emitters[_resource_type] = file_path.open('w')
+            emitters[_resource_type] = file_path.open('wb')
             open_files.append(file_path)
         return emitters[_resource_type]
 
@@ -80,8 +85,7 @@ def fhir_get(project_id, path, elastic_url) -> list[str]:
         resource_type = _['_source']['resourceType']
         _file = _emitter(resource_type)
         del _['_source']['auth_resource_path']
-        json.dump(_['_source'], _file)
-        _file.write('\n')
+        _file.write(orjson.dumps(_['_source'], option=orjson.OPT_APPEND_NEWLINE))
 
     for file in emitters.values():
         file.close()
@@ -113,14 +117,13 @@ def _fhir_put(project_id, output_format, path, elastic_url):
         json.dump(logs, sys.stdout, indent=2)
 
 
-
 @fhir_store.command(name='get')
 @click.option('--project_id', required=True, show_default=True,
               help="Gen3 program-project")
 @click.option('--format', 'output_format',
-             default='yaml',
-             show_default=True,
-             type=click.Choice(['yaml', 'json'], case_sensitive=False))
+              default='yaml',
+              show_default=True,
+              type=click.Choice(['yaml', 'json'], case_sensitive=False))
 @click.option('--elastic_url', default=DEFAULT_ELASTIC, show_default=True)
 @click.argument('path', default=None, required=True)
 def _fhir_get(project_id, output_format, path, elastic_url):
@@ -5,22 +5,21 @@ from typing import Iterator
 import fastjsonschema
 import inflection
 import orjson
-import requests
-from dictionaryutils import DataDictionary
 from jsonschema.exceptions import ValidationError
 
-from aced_submission.util import _to_file, ParseResult
+from aced_submission.util import _to_file, load_schema, ParseResult
 
 logger = logging.getLogger(__name__)
 
-LOGGED_ALREADY = []
+LOGGED_ALREADY = set()
 COMPILED_SCHEMAS = {}
+EXPECTED_KEYS = {}
 
 
 def log_once(msg):
     if msg not in LOGGED_ALREADY:
         logger.info(msg)
-        LOGGED_ALREADY.append(msg)
+        LOGGED_ALREADY.add(msg)
 
 
 def _validate(gen3_resource: dict, schemas: dict):
@@ -35,9 +34,13 @@ def _validate(gen3_resource: dict, schemas: dict):
         key = inflection.underscore(resource_type)
         schema = schemas.get(key, schemas.get(f"{key}.yaml", None))
         assert schema, f"Could not find schema for {key}"
-        actual_keys = set(resource.keys())
-        expected_keys = set(schema['properties'].keys()).union(set([_['name'] for _ in schema['links']]))
-        if not actual_keys.issubset(expected_keys):
+        actual_keys = resource.keys()
+        expected_keys = EXPECTED_KEYS.get(key, None)
+        if expected_keys is None:
+            # properties and link names, built once per schema
+            expected_keys = frozenset(schema['properties']).union(_['name'] for _ in schema['links'])
+            EXPECTED_KEYS[key] = expected_keys
+        if not actual_keys <= expected_keys:
             if not schema.get('additionalProperties', False):
                 assert False, f"Is not a subset {actual_keys - expected_keys} not expected"
             else:
@@ -79,10 +82,7 @@ def directory_reader(
 
     assert directory_path.is_dir(), f"{directory_path.name} is not a directory"
 
-    if 'http' in schema_path:
-        schemas = requests.get(schema_path).json()
-    else:
-        schemas = DataDictionary(local_file=schema_path).schema
+    schemas = load_schema(schema_path)
 
     input_files = [_ for _ in directory_path.glob(pattern)]
     for input_file in input_files:
@@ -92,7 +92,7 @@ def directory_reader(
         fp = _to_file(input_file)
         with fp:
             offset = 0
-            for line in fp.readlines():
+            for line in fp:
                 gen3_resource = orjson.loads(line)
                 parse_result = _validate(gen3_resource, schemas=schemas)
                 parse_result.path = input_file
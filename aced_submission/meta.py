@@ -79,7 +79,7 @@ def _meta_mapping(dictionary_path, config_path, output_format):
     assert dictionary_path, '--dictionary_path is required'
     dictionary_dir = dictionary_path if 'http' not in dictionary_path else None
     dictionary_url = dictionary_path if 'http' in dictionary_path else None
-    mappings = [mapping for mapping in _table_mappings(dictionary_dir, dictionary_url)]
+    mappings = list(_table_mappings(dictionary_dir, dictionary_url))
     if output_format == 'yaml':
         yaml.dump(mappings, sys.stdout, default_flow_style=False)
     else:
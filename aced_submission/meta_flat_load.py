@@ -2,24 +2,24 @@
 
 
 import csv
-import json
 import logging
 import os
 import pathlib
 import sqlite3
+import time
 import uuid
+from contextlib import contextmanager
+from collections import defaultdict
 from datetime import datetime
-from functools import lru_cache
-from itertools import islice
-from typing import Dict, Iterator
+from typing import Dict, Iterator, List
 
 import click
 import elasticsearch
 import orjson
-import requests
-from dictionaryutils import DataDictionary
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import parallel_bulk
+
+from aced_submission.util import load_schema, prefetch, read_ndjson
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -36,19 +36,25 @@ ES_INDEX_PREFIX = "gen3.aced.io"
 
 ACED_NAMESPACE = uuid.uuid3(uuid.NAMESPACE_DNS, 'aced-ipd.org')
 
+# schema property type to elastic field type, anything else is mapped to float
+PROP_TYPE_TO_ES = {'string': 'keyword', 'boolean': 'keyword', 'array': 'keyword'}
+
+# index settings while bulk loading, and the settings put back afterwards
+BULK_LOAD_INDEX_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+LOADED_INDEX_SETTINGS = {'refresh_interval': '1s', 'number_of_replicas': 1}
+
+# patient and condition fields copied onto each observation
+DENORMALIZED_PATIENT_FIELDS = [
+    'us_core_race', 'address', 'gender', 'birthDate', 'us_core_ethnicity', 'address_orh_zip_designation_code',
+    'condition', 'condition_code', 'family_history_condition', 'family_history_condition_code'
+]
+
 
 def create_id(key: str) -> str:
     """Create an idempotent ID from the input string."""
     return str(uuid.uuid5(ACED_NAMESPACE, key))
 
 
-def read_ndjson(path: str) -> Iterator[Dict]:
-    """Read ndjson file, load json line by line."""
-    with open(path) as jsonfile:
-        for l_ in jsonfile.readlines():
-            yield json.loads(l_)
-
-
 def read_tsv(path: str) -> Iterator[Dict]:
     """Read tsv file line by line."""
     with open(path) as tsv_file:
@@ -83,39 +89,21 @@ def create_index_from_source(_schema, _index, _type):
             else:
                 prop_type = v['type']
 
-        if prop_type in ['string']:
-            mappings[k] = {
-                "type": "keyword"
-            }
-        elif prop_type in ['boolean']:
-            mappings[k] = {
-                "type": "keyword"
-            }
-        elif 'date' in prop_type:
-            mappings[k] = {
-                "type": "date"
-            }
-        elif 'array' in prop_type:
-            mappings[k] = {
-                "type": "keyword"
-            }
+        if 'date' in prop_type:
+            mappings[k] = {"type": "date"}
+        elif isinstance(prop_type, list):
+            # a $ref to a list of types, matched by membership as before, unhashable for PROP_TYPE_TO_ES
+            mappings[k] = {"type": 'keyword' if 'array' in prop_type else 'float'}
         else:
             # naive, there are probably other types
-            mappings[k] = {"type": "float"}
-        # we have a patient centric index approach, all links include a `patient`
-        mappings['patient_id'] = {"type": "keyword"}
-        # patient fields copied to observation
-        if _type == 'observation':
-            mappings['us_core_race'] = {"type": "keyword"}
-            mappings['address'] = {"type": "keyword"}
-            mappings['gender'] = {"type": "keyword"}
-            mappings['birthDate'] = {"type": "keyword"}
-            mappings['us_core_ethnicity'] = {"type": "keyword"}
-            mappings['address_orh_zip_designation_code'] = {"type": "keyword"}
-            mappings['condition'] = {"type": "keyword"}
-            mappings['condition_code'] = {"type": "keyword"}
-            mappings['family_history_condition'] = {"type": "keyword"}
-            mappings['family_history_condition_code'] = {"type": "keyword"}
+            mappings[k] = {"type": PROP_TYPE_TO_ES.get(prop_type, 'float')}
+
+    # we have a patient centric index approach, all links include a `patient`
+    mappings['patient_id'] = {"type": "keyword"}
+    # patient fields copied to observation
+    if _type == 'observation':
+        for k in DENORMALIZED_PATIENT_FIELDS:
+            mappings[k] = {"type": "keyword"}
 
     mappings['auth_resource_path'] = {"type": "keyword"}
 
@@ -213,90 +201,149 @@ def create_indexes(_schema, _index, doc_type, elastic=DEFAULT_ELASTIC):
     }
 
 
+def _sqlite_connection(file_name) -> sqlite3.Connection:
+    """Connect to a scratch sqlite db with a large page cache and memory mapped reads."""
+    connection = sqlite3.connect(file_name)
+    connection.execute('PRAGMA cache_size=-262144')  # 256MB
+    connection.execute('PRAGMA mmap_size=1073741824')  # 1GB
+    connection.execute('PRAGMA temp_store=MEMORY')
+    return connection
+
+
+def _sqlite_bulk_connection(file_name) -> sqlite3.Connection:
+    """Connect to a scratch sqlite db tuned for bulk load, it is rebuilt on every run so skip fsync."""
+    connection = _sqlite_connection(file_name)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=OFF')
+    return connection
+
+
 def write_sqlite(index, generator):
     """Write to sqlite"""
-    connection = sqlite3.connect(f'{index}.sqlite')
+    connection = _sqlite_bulk_connection(f'{index}.sqlite')
     with connection:
         connection.execute(f'DROP table IF EXISTS {index}')
-        connection.execute(f'CREATE TABLE if not exists {index} (id PRIMARY KEY, entity Text)')
+        connection.execute(f'CREATE TABLE if not exists {index} (id PRIMARY KEY, entity BLOB)')
         with connection:
             connection.executemany(f'insert into {index} values (?, ?)',
-                                   [(entity['id'], orjson.dumps(entity).decode(),) for entity in generator])
+                                   ((entity['id'], orjson.dumps(entity)) for entity in generator))
 
 
-def write_bulk_http(elastic, index, limit, doc_type, generator, schema):
+def write_bulk_http(elastic, index, limit, doc_type, generator, schema,
+                    thread_count=4, chunk_size=1000, max_chunk_bytes=10 * 1024 * 1024):
     """Use efficient method to write to elastic"""
-    counter = 0
 
-    def _bulker(generator_, counter_=counter):
+    def _bulker(generator_):
+        counter_ = 0
+        # the bulk helpers copy each action as it is consumed, so a single dict is reused
+        action = {
+            '_index': index,
+            '_op_type': 'index',
+            '_type': doc_type,
+            '_source': None,
+            '_id': None
+        }
         for dict_ in generator_:
-            if limit and counter_ > limit:
+            if limit and counter_ >= limit:
                 break  # for testing
-            yield {
-                '_index': index,
-                '_op_type': 'index',
-                '_type': doc_type,
-                '_source': dict_,
-                # use the id from the FHIR object to upsert information
-                '_id': dict_['id']
-            }
+            action['_source'] = dict_
+            # use the id from the FHIR object to upsert information
+            action['_id'] = dict_['id']
+            yield action
             counter_ += 1
             if counter_ % 10000 == 0:
                 logger.info(f"{counter_} records written")
         logger.info(f"{counter_} records written")
 
     if schema:
-        logger.info(f'Creating {doc_type} indices.')
-        index_dict = create_indexes(schema, _index=index, doc_type=doc_type)
-
-        try:
-            elastic.indices.create(index=index_dict['index'], body=index_dict['json'])
-        except Exception as e:
-            if 'resource_already_exists_exception' in str(e):
-                logger.debug(f"Could not create index. {index} {str(e)}")
-                logger.debug("Continuing to load.")
-            else:
-                raise e
+        create_bulk_index(elastic, index, doc_type, schema)
 
     logger.info(f'Writing bulk to {index} limit {limit}.')
-    _ = bulk(client=elastic,
-             actions=(d for d in _bulker(generator)),
-             request_timeout=120)
+    errors = 0
+    # report rejected documents rather than abort the whole load on the first one
+    for ok, info in parallel_bulk(client=elastic,
+                                  actions=_bulker(generator),
+                                  thread_count=thread_count,
+                                  queue_size=thread_count,
+                                  chunk_size=chunk_size,
+                                  max_chunk_bytes=max_chunk_bytes,
+                                  raise_on_error=False,
+                                  request_timeout=120):
+        if not ok:
+            errors += 1
+            logger.error(info)
+    if errors:
+        logger.error(f"{errors} documents were not written to {index}")
+
+
+def create_bulk_index(elastic, index, doc_type, schema):
+    """Create index with mappings from the gen3 schema, unless it already exists."""
+    if elastic.indices.exists(index=index):
+        # steady-state reload, skip building the mapping from the schema
+        logger.info(f'Index {index} exists, not creating.')
+        return
+    logger.info(f'Creating {doc_type} indices.')
+    index_dict = create_indexes(schema, _index=index, doc_type=doc_type)
 
+    try:
+        elastic.indices.create(index=index_dict['index'], body=index_dict['json'])
+    except Exception as e:
+        if 'resource_already_exists_exception' in str(e):
+            logger.debug(f"Could not create index. {index} {str(e)}")
+            logger.debug("Continuing to load.")
+        else:
+            raise e
 
-def observation_generator(project_id, path) -> Iterator[Dict]:
-    """Render guppy index for observation."""
+
+@contextmanager
+def bulk_load_settings(elastic, index):
+    """Suspend refresh and replication of index while loading, then set LOADED_INDEX_SETTINGS."""
+    if not elastic.indices.exists(index=index):
+        # index will be created by the first bulk request, with default settings
+        yield
+        return
+    elastic.indices.put_settings(index=index, body={"index": BULK_LOAD_INDEX_SETTINGS})
+    try:
+        yield
+    finally:
+        # known values, not ones read back from a shared index another loader may have changed
+        elastic.indices.put_settings(index=index, body={"index": LOADED_INDEX_SETTINGS})
+
+
+def _project_tags(project_id) -> Dict[str, str]:
+    """Fields common to every document in the project."""
     program, project = project_id.split('-')
+    return {
+        'project_id': project_id,
+        'auth_resource_path': f"/programs/{program}/projects/{project}"
+    }
+
 
-    connection = sqlite3.connect('denormalized_patient.sqlite')
+def observation_generator(project_id, path) -> Iterator[Dict]:
+    """Render guppy index for observation."""
+    project_tags = _project_tags(project_id)
+    _lower = str.lower
+    denormalized_patients = load_denormalized_patients()
 
     for observation in read_ndjson(path):
         o_ = observation['object']
 
-        o_['project_id'] = project_id
-        o_["auth_resource_path"] = f"/programs/{program}/projects/{project}"
+        o_.update(project_tags)
         for relation in observation['relations']:
-            dst_name = relation['dst_name'].lower()
-            dst_id = relation['dst_id']
-            o_[f'{dst_name}_id'] = dst_id
-
-        #
-        for required_field in []:
-            if required_field not in o_:
-                o_[required_field] = None
+            o_[_lower(relation['dst_name']) + '_id'] = relation['dst_id']
 
         assert 'patient_id' in o_, observation
 
-        denormalized_patient = fetch_denormalized_patient(connection, o_['patient_id'])
-        condition, condition_coding, fh_condition, fh_condition_coding, patient = (
-            denormalized_patient['condition'],
-            denormalized_patient['condition_coding'],
-            denormalized_patient['fh_condition'],
-            denormalized_patient['fh_condition_coding'],
-            denormalized_patient['patient'],
-        )
+        denormalized_patient = denormalized_patients.get(o_['patient_id'])
+        patient = denormalized_patient['patient'] if denormalized_patient else None
 
         if patient:
+            condition, condition_coding, fh_condition, fh_condition_coding = (
+                denormalized_patient['condition'],
+                denormalized_patient['condition_coding'],
+                denormalized_patient['fh_condition'],
+                denormalized_patient['fh_condition_coding'],
+            )
             o_['us_core_race'] = patient.get('us_core_race', None)
             o_['address'] = patient.get('address', None)
             o_['gender'] = patient.get('gender', None)
@@ -312,77 +359,78 @@ def observation_generator(project_id, path) -> Iterator[Dict]:
         yield o_
 
 
-@lru_cache(maxsize=1024 * 10)
-def fetch_denormalized_patient(connection, patient_id):
-    """Retrieve unique conditions and family history"""
+def load_denormalized_patients() -> Dict[str, Dict]:
+    """Read unique conditions and family history for every patient, keyed by patient id."""
 
-    fh_condition = []
-    fh_condition_coding = []
-    condition = []
-    condition_coding = []
-    patient = None
+    denormalized_patients = {}
+    # serialized values already appended, per patient and list; replaces `if _ not in list` scans
+    seen = defaultdict(set)
 
-    for row in connection.execute('select entity from patient where id = ? limit 1', (patient_id,)):
-        patient = orjson.loads(row[0])
-        break
-
-    for row in connection.execute('select entity from family_history where patient_id = ? ', (patient_id,)):
-        family_history = orjson.loads(row[0])
-        for _ in family_history['condition']:
-            if _ not in fh_condition:
-                fh_condition.append(_)
-        for _ in family_history['condition_coding']:
-            if _ not in fh_condition_coding:
-                fh_condition_coding.append(_)
+    def _denormalized_patient(patient_id):
+        if patient_id not in denormalized_patients:
+            denormalized_patients[patient_id] = {
+                'patient': None, 'condition': [], 'condition_coding': [],
+                'fh_condition': [], 'fh_condition_coding': []
+            }
+        return denormalized_patients[patient_id]
 
-    for row in connection.execute('select entity from condition where patient_id = ? ', (patient_id,)):
-        condition_ = orjson.loads(row[0])
-        if condition_['code'] not in condition:
-            condition.append(condition_['code'])
-            condition_coding.append(condition_['code_coding'])
+    def _is_new(patient_id, name, value) -> bool:
+        key = orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+        seen_ = seen[(patient_id, name)]
+        if key in seen_:
+            return False
+        seen_.add(key)
+        return True
 
-    return {
-        'patient': patient, 'condition': condition, 'condition_coding': condition_coding,
-        'fh_condition': fh_condition, 'fh_condition_coding': fh_condition_coding
-    }
+    connection = _sqlite_connection('denormalized_patient.sqlite')
+    with connection:
+        for patient_id, entity in connection.execute('select id, entity from patient'):
+            _denormalized_patient(patient_id)['patient'] = orjson.loads(entity)
+
+        for patient_id, entity in connection.execute('select patient_id, entity from family_history'):
+            family_history = orjson.loads(entity)
+            denormalized_patient = _denormalized_patient(patient_id)
+            for _ in family_history['condition']:
+                if _is_new(patient_id, 'fh_condition', _):
+                    denormalized_patient['fh_condition'].append(_)
+            for _ in family_history['condition_coding']:
+                if _is_new(patient_id, 'fh_condition_coding', _):
+                    denormalized_patient['fh_condition_coding'].append(_)
+
+        for patient_id, entity in connection.execute('select patient_id, entity from condition'):
+            condition_ = orjson.loads(entity)
+            denormalized_patient = _denormalized_patient(patient_id)
+            if _is_new(patient_id, 'condition', condition_['code']):
+                denormalized_patient['condition'].append(condition_['code'])
+                denormalized_patient['condition_coding'].append(condition_['code_coding'])
+    connection.close()
+
+    return denormalized_patients
 
 
 def patient_generator(project_id, path) -> Iterator[Dict]:
     """Render guppy index for patient."""
-    program, project = project_id.split('-')
+    project_tags = _project_tags(project_id)
     for patient in read_ndjson(path):
         p_ = patient['object']
         p_['id'] = patient['id']
 
-        p_['project_id'] = project_id
-        p_["auth_resource_path"] = f"/programs/{program}/projects/{project}"
-
-        #
-        for required_field in []:
-            if required_field not in p_:
-                p_[required_field] = None
+        p_.update(project_tags)
         yield p_
 
 
 def file_generator(project_id, path) -> Iterator[Dict]:
     """Render guppy index for file."""
-    program, project = project_id.split('-')
+    project_tags = _project_tags(project_id)
+    _lower = str.lower
     for file in read_ndjson(path):
         f_ = file['object']
         f_['id'] = file['id']
 
-        f_['project_id'] = project_id
-        f_["auth_resource_path"] = f"/programs/{program}/projects/{project}"
+        f_.update(project_tags)
 
         for relation in file['relations']:
-            dst_name = relation['dst_name'].lower()
-            dst_id = relation['dst_id']
-            f_[f'{dst_name}_id'] = dst_id
-
-        #
-        for required_field in []:
-            if required_field not in f_:
-                f_[required_field] = None
+            f_[_lower(relation['dst_name']) + '_id'] = relation['dst_id']
         yield f_
 
 
@@ -438,19 +486,19 @@ def write_flat_file(output_path, index, doc_type, limit, generator, schema):
 
     pathlib.Path(output_path).mkdir(parents=True, exist_ok=True)
 
-    with open(f"{output_path}/{doc_type}.ndjson", "wb") as fp:
+    # serialized immediately, so a single wrapper dict is reused
+    record = {
+        'id': None,
+        'object': None,
+        'name': doc_type,
+        'relations': []
+    }
+    # a 1MB write buffer batches the per record writes
+    with open(f"{output_path}/{doc_type}.ndjson", "wb", buffering=1 << 20) as fp:
         for dict_ in generator:
-            fp.write(
-                orjson.dumps(
-                    {
-                        'id': dict_['id'],
-                        'object': dict_,
-                        'name': doc_type,
-                        'relations': []
-                    }
-                )
-            )
-            fp.write(b'\n')
+            record['id'] = dict_['id']
+            record['object'] = dict_
+            fp.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
 
             counter_ += 1
             if counter_ % 10000 == 0:
@@ -473,43 +521,39 @@ def denormalize_patient(input_path):
 
     path = pathlib.Path(input_path)
 
-    def _load_vertex(file_name):
-        """Get the object and patient id"""
+    def _load_vertex(file_name, has_patient=True):
+        """Yield (id, patient_id, entity) rows, or (id, entity) if not has_patient."""
         if not (path / file_name).is_file():
             return
         for _ in read_ndjson(path / file_name):
+            object_ = _['object']
+            entity = orjson.dumps(object_)
+            if not has_patient:
+                yield object_['id'], entity
+                continue
+            relations = _['relations']
             patient_id = None
-            if len(_['relations']) == 1 and _['relations'][0]['dst_name'] == 'Patient':
-                patient_id = _['relations'][0]['dst_id']
-            _ = _['object']
-            _['id'] = _['id']
-            if patient_id:
-                _['patient_id'] = patient_id
-            yield _
-
-    connection = sqlite3.connect('denormalized_patient.sqlite')
+            if len(relations) == 1 and relations[0]['dst_name'] == 'Patient':
+                patient_id = relations[0]['dst_id']
+            yield object_['id'], patient_id, entity
+
+    connection = _sqlite_bulk_connection('denormalized_patient.sqlite')
     with connection:
         connection.execute('DROP table IF EXISTS patient')
         connection.execute('DROP table IF EXISTS family_history')
         connection.execute('DROP table IF EXISTS condition')
-        connection.execute('CREATE TABLE if not exists patient (id PRIMARY KEY, entity Text)')
-        connection.execute('CREATE TABLE if not exists family_history (id PRIMARY KEY, patient_id Text, entity Text)')
-        connection.execute('CREATE TABLE if not exists condition (id PRIMARY KEY, patient_id Text, entity Text)')
+        connection.execute('CREATE TABLE if not exists patient (id PRIMARY KEY, entity BLOB)')
+        connection.execute('CREATE TABLE if not exists family_history (id PRIMARY KEY, patient_id Text, entity BLOB)')
+        connection.execute('CREATE TABLE if not exists condition (id PRIMARY KEY, patient_id Text, entity BLOB)')
     with connection:
         connection.executemany('insert into patient values (?, ?)',
-                               [(entity['id'], orjson.dumps(entity).decode(),) for entity in
-                                _load_vertex('Patient.ndjson')])
+                               prefetch(_load_vertex('Patient.ndjson', has_patient=False)))
     with connection:
         connection.executemany('insert into family_history values (?, ?, ?)',
-                               [(entity['id'], entity['patient_id'], orjson.dumps(entity).decode(),) for entity in
-                                _load_vertex('FamilyMemberHistory.ndjson')])
+                               prefetch(_load_vertex('FamilyMemberHistory.ndjson')))
     with connection:
         connection.executemany('insert into condition values (?, ?, ?)',
-                               [(entity['id'], entity['patient_id'], orjson.dumps(entity).decode(),) for entity in
-                                _load_vertex('Condition.ndjson')])
-    with connection:
-        connection.execute('CREATE INDEX if not exists condition_patient_id on condition(patient_id)')
-        connection.execute('CREATE INDEX if not exists family_history_patient_id on condition(patient_id)')
+                               prefetch(_load_vertex('Condition.ndjson')))
 
 
 @cli.command('load')
@@ -543,12 +587,42 @@ def denormalize_patient(input_path):
               show_default=True,
               help='Do not load elastic, write flat model to file instead'
               )
-def _load_flat(project_id, index, path, limit, elastic_url, schema_path, output_path):
+@click.option('--thread_count', default=4, show_default=True,
+              help='Number of threads sending bulk requests to elastic')
+@click.option('--chunk_size', default=1000, show_default=True,
+              help='Max number of documents per bulk request')
+@click.option('--max_chunk_bytes', default=10 * 1024 * 1024, show_default=True,
+              help='Max size of a bulk request in bytes')
+def _load_flat(project_id, index, path, limit, elastic_url, schema_path, output_path,
+               thread_count, chunk_size, max_chunk_bytes):
     """Gen3 Elastic Search data into guppy (patient, observation, files, etc.)."""
-    load_flat(project_id, index, path, limit, elastic_url, schema_path, output_path)
+    load_flat(project_id, index, path, limit, elastic_url, schema_path, output_path,
+              thread_count=thread_count, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes)
 
 
-def load_flat(project_id, index, path, limit, elastic_url, schema_path, output_path):
+def _array_fields(properties) -> List[str]:
+    """Names of properties typed 'array' or ['array', ...], not substring matches."""
+    field_array = []
+    for k, v in properties.items():
+        if not isinstance(v, dict):
+            continue
+        type_ = v.get('type')
+        if type_ == 'array' or (isinstance(type_, list) and 'array' in type_):
+            field_array.append(k)
+    return field_array
+
+
+# guppy index (also doc type and alias) -> schema entry, document generator
+# TODO fix me - we should have a index called document_reference not file
+FLAT_INDEXES = {
+    'patient': ('patient.yaml', patient_generator),
+    'observation': ('observation.yaml', observation_generator),
+    'file': ('document_reference.yaml', file_generator),
+}
+
+
+def load_flat(project_id, index, path, limit, elastic_url, schema_path, output_path,
+              thread_count=4, chunk_size=1000, max_chunk_bytes=10 * 1024 * 1024):
     # replaces tube_lite
 
     if limit:
@@ -558,69 +632,28 @@ def load_flat(project_id, index, path, limit, elastic_url, schema_path, output_p
 
     index = index.lower()
 
-    if 'http' in schema_path:
-        schema = requests.get(schema_path).json()
-    else:
-        schema = DataDictionary(local_file=schema_path).schema
-
-    if index == 'patient':
-        doc_type = 'patient'
-        index = f"{ES_INDEX_PREFIX}_{doc_type}_0"
-        alias = 'patient'
-        field_array = [k for k, v in schema['patient.yaml']['properties'].items() if 'array' in v.get('type', {})]
-
-        if not output_path:
-            # create the index and write data into it.
-            write_bulk_http(elastic=elastic, index=index, doc_type=doc_type, limit=limit,
-                            generator=patient_generator(project_id, path), schema=schema)
+    schema = load_schema(schema_path)
 
-            setup_aliases(alias, doc_type, elastic, field_array, index)
-        else:
-            # write file path
-            write_flat_file(output_path=output_path, index=index, doc_type=doc_type, limit=limit,
-                            generator=patient_generator(project_id, path), schema=schema)
-
-    if index == 'observation':
-        doc_type = 'observation'
-        index = f"{ES_INDEX_PREFIX}_{doc_type}_0"
-        alias = 'observation'
-        field_array = [k for k, v in schema['observation.yaml']['properties'].items() if 'array' in v.get('type', {})]
-        # field_array = ['data_format', 'data_type', '_file_id', 'medications', 'conditions']
-
-        if not output_path:
-            # create the index and write data into it.
-            write_bulk_http(elastic=elastic, index=index, doc_type=doc_type, limit=limit,
-                            generator=observation_generator(project_id, path), schema=schema)
+    assert index in FLAT_INDEXES, f"index should be one of {list(FLAT_INDEXES)}"
+    doc_type = alias = index
+    schema_key, generator = FLAT_INDEXES[doc_type]
+    index = f"{ES_INDEX_PREFIX}_{doc_type}_0"
+    field_array = _array_fields(schema[schema_key]['properties'])
 
-            setup_aliases(alias, doc_type, elastic, field_array, index)
-        else:
-            # write file path
-            write_flat_file(output_path=output_path, index=index, doc_type=doc_type, limit=limit,
-                            generator=observation_generator(project_id, path), schema=schema)
-
-    if index == 'file':
-        doc_type = 'file'
-        alias = 'file'
-        index = f"{ES_INDEX_PREFIX}_{doc_type}_0"
-        field_array = [k for k, v in schema['document_reference.yaml']['properties'].items() if
-                       isinstance(v, dict) and 'array' in v.get('type',
-                                                                {})]
-        if not output_path:
-            # create the index and write data into it.
+    if not output_path:
+        # create the index and write data into it.
+        create_bulk_index(elastic, index, doc_type, schema)
+        with bulk_load_settings(elastic, index):
+            # index created above, before its settings are changed
             write_bulk_http(elastic=elastic, index=index, doc_type=doc_type, limit=limit,
-                            generator=file_generator(project_id, path), schema=schema)
-
-            setup_aliases(alias, doc_type, elastic, field_array, index)
-        else:
-            # write file path
-            write_flat_file(output_path=output_path, index=index, doc_type=doc_type, limit=limit,
-                            generator=file_generator(project_id, path), schema=schema)
+                            generator=generator(project_id, path), schema=None,
+                            thread_count=thread_count, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes)
 
-
-def chunk(arr_range, arr_size):
-    """Iterate in chunks."""
-    arr_range = iter(arr_range)
-    return iter(lambda: tuple(islice(arr_range, arr_size)), ())
+        setup_aliases(alias, doc_type, elastic, field_array, index)
+    else:
+        # write file path
+        write_flat_file(output_path=output_path, index=index, doc_type=doc_type, limit=limit,
+                        generator=generator(project_id, path), schema=schema)
 
 
 @cli.command('counts')
@@ -644,11 +677,24 @@ def counts(project_id):
             "match": {
                 "auth_resource_path": f"/programs/{program}/projects/{project}"
             }
-        }
+        },
+        "size": 0,
+        "track_total_hits": True
     }
-    for index in ['patient', 'observation', 'file']:
+    indexes = ['patient', 'observation', 'file']
+    # one round trip for all indexes, header and body alternate
+    body = []
+    for index in indexes:
         # index = f"{ES_INDEX_PREFIX}_{index}_0"
-        print(index, elastic.count(index=index, body=query)['count'])
+        body.extend([{"index": index}, query])
+    responses = elastic.msearch(body=body)['responses']
+    for index, response in zip(indexes, responses):
+        if 'error' in response:
+            print(index, response['error'].get('type', response['error']))
+            continue
+        # elasticsearch 6 returns the total as an int, 7+ as {'value': ..., 'relation': ...}
+        total = response['hits']['total']
+        print(index, total['value'] if isinstance(total, dict) else total)
 
 
 @cli.command('rm')
@@ -681,8 +727,15 @@ def delete(project_id, index):
             }
         }
     }
-    print("deleting, waiting up to 5 min. for response")
-    print(index, elastic.delete_by_query(index=index, body=query, timeout='5m'))
+    # run as a background task, sliced across the index's shards, and poll it
+    task_id = elastic.delete_by_query(index=index, body=query, timeout='5m', slices='auto',
+                                      wait_for_completion=False)['task']
+    print(f"deleting, task {task_id}")
+    task = elastic.tasks.get(task_id=task_id)
+    while not task['completed']:
+        time.sleep(5)
+        task = elastic.tasks.get(task_id=task_id)
+    print(index, task.get('response', task.get('error')))
 
 
 if __name__ == '__main__':
@@ -1,11 +1,13 @@
 import io
 import logging
 import pathlib
+import struct
 import uuid
 from collections import defaultdict
-from datetime import datetime
-from itertools import islice
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial
+from typing import Dict, Iterator, List, Tuple
 
 import yaml
 from dictionaryutils import DataDictionary, dictionary
@@ -14,14 +16,22 @@ from yaml import SafeLoader
 import psycopg2
 import json
 import inflection
+import orjson
 
 from aced_submission.pelican import DataDictionaryTraversal
+from aced_submission.util import chunk, prefetch
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logging.getLogger('elasticsearch').setLevel(logging.WARNING)
 
-LOGGED_ALREADY = []
+LOGGED_ALREADY = set()
+# edge tables with fewer rows than this are upserted from arrays rather than staged with COPY
+UNNEST_EDGE_LIMIT = 1000
+# edge pairs buffered from an entity file before they are written and committed
+EDGE_FLUSH_LIMIT = 100000
+# relation dst_name values come from a handful of resource types
+_camelize = lru_cache(maxsize=256)(inflection.camelize)
 
 
 def _connect_to_postgres():
@@ -29,6 +39,14 @@ def _connect_to_postgres():
     return psycopg2.connect('')
 
 
+def _bulk_load_session(connection):
+    """Tune a connection for bulk loading, commits don't wait for the WAL flush."""
+    with connection.cursor() as cursor:
+        cursor.execute("SET synchronous_commit = off")
+    connection.commit()
+    return connection
+
+
 def _init_dictionary(root_dir_=None, dictionary_url=None):
     """Initialize gen3 data dictionary from either directory or url"""
     d = DataDictionary(root_dir=root_dir_, url=dictionary_url)
@@ -54,185 +72,340 @@ def _table_mappings(dictionary_path, dictionary_url):
         '__src_table__',
         '__tablename__'
     ]
+    # edge attribute -> mapping key, computed once for all edges
+    key_map = {k: k.replace('_', '') for k in desired_keys}
 
     def _transform(ddt_) -> List[dict]:
         for d in ddt_.get_edges():
-            yield {k.replace('_', ''): v for k, v in d.__dict__.items() if k in desired_keys}
+            yield {key_map[k]: v for k, v in d.__dict__.items() if k in key_map}
 
     mapping = _transform(ddt)
     return mapping
 
 
-def chunk(arr_range, arr_size):
-    """Iterate in chunks."""
-    arr_range = iter(arr_range)
-    return iter(lambda: tuple(islice(arr_range, arr_size)), ())
+# postgres binary COPY framing, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+# jsonb is a version byte followed by the json text
+JSONB_VERSION = b'\x01'
+EMPTY_JSONB = JSONB_VERSION + b'{}'
+# zero dimensions, no nulls, element type text (oid 25)
+EMPTY_TEXT_ARRAY = struct.pack('!iii', 0, 0, 25)
+
+
+def _pg_timestamp(dt: datetime) -> bytes:
+    """Binary timestamptz, microseconds since 2000-01-01 UTC."""
+    return struct.pack('!q', (dt - PG_EPOCH) // timedelta(microseconds=1))
+
+
+def _copy_binary_row(*fields: bytes) -> bytes:
+    """Binary COPY tuple, field count then length prefixed fields."""
+    row = [struct.pack('!h', len(fields))]
+    for field in fields:
+        row.append(struct.pack('!i', len(field)))
+        row.append(field)
+    return b''.join(row)
+
+
+def _vertex_copy_buffers(f, project_id) -> Iterator[Tuple[io.BytesIO, int]]:
+    """Encode blocks of ndjson vertices as binary COPY buffers, with their record count."""
+    for lines in chunk(f, 1000):
+        # copy a block of records into a file like buffer
+        buf = io.BytesIO()
+        buf.write(PGCOPY_HEADER)
+        created = _pg_timestamp(datetime.now(timezone.utc))
+        for line in lines:
+            d_ = orjson.loads(line)
+            d_['object']['project_id'] = project_id
+            buf.write(_copy_binary_row(
+                d_['id'].encode(),
+                JSONB_VERSION + orjson.dumps(d_['object']),
+                EMPTY_TEXT_ARRAY,
+                EMPTY_JSONB,
+                created
+            ))
+        buf.write(PGCOPY_TRAILER)
+        buf.seek(0)
+        yield buf, len(lines)
+
+
+def _secondary_indexes(cursor, table_name) -> List[Tuple[str, str]]:
+    """(name, definition) of the indexes on table_name not backing a primary key or unique constraint."""
+    cursor.execute(
+        """
+        SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = %s::regclass AND NOT i.indisprimary AND NOT i.indisunique
+        """,
+        (table_name,)
+    )
+    return cursor.fetchall()
+
+
+def _load_vertex_file(connection, path, data_table_name, project_id):
+    """Upsert one entity file into its vertex table."""
+    logger.info(f"loading {path} into {data_table_name}")
+
+    columns = ['node_id', '_props', 'acl', '_sysan', 'created']
+    # Select only columns to be updated (in my case, all non-id columns)
+    # update_set = ", ".join([f"{v}=EXCLUDED.{v}" for v in ['_props', 'acl', '_sysan', 'created']])
+    update_set = ' _props=EXCLUDED._props, acl=EXCLUDED.acl, _sysan=EXCLUDED._sysan, created=EXCLUDED.created '
+
+    with connection.cursor() as cursor:
+        # Creates temporary empty table with same columns and types as
+        # the final table, the whole file is staged then upserted, dropped when the entity is committed
+        cursor.execute(
+            f"""
+            CREATE TEMPORARY TABLE tmp_{data_table_name} (LIKE {data_table_name})
+            ON COMMIT DROP
+            """
+        )
+        with open(path, 'rb') as f:
+            record_count = 0
+            # blocks are parsed and encoded on a worker thread while the previous block is copied
+            for buf, block_count in prefetch(_vertex_copy_buffers(f, project_id), maxsize=2):
+                record_count += block_count
+                # efficient way to write to postgres, binary skips server side parsing
+                cursor.copy_expert(
+                    f"COPY tmp_{data_table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT BINARY)", buf
+                )
+                logger.info(f"staged {record_count} records for {data_table_name} from {path}")
+        # first load into an empty table, build the secondary indexes once after the insert
+        cursor.execute(f"SELECT 1 FROM {data_table_name} LIMIT 1")
+        secondary_indexes = _secondary_indexes(cursor, data_table_name) if cursor.fetchone() is None else []
+        for index_name, _ in secondary_indexes:
+            cursor.execute(f'DROP INDEX "{index_name}"')
+        # handle conflicts, a single upsert can only touch a node once so the last staged copy wins
+        cursor.execute(
+            f"""
+            INSERT INTO {data_table_name}({', '.join(columns)})
+            SELECT DISTINCT ON (node_id) node_id, _props::jsonb, acl, _sysan, created FROM tmp_{data_table_name}
+            ORDER BY node_id, ctid DESC
+            ON CONFLICT (node_id) DO UPDATE SET {update_set}
+            """
+        )
+        for _, index_definition in secondary_indexes:
+            cursor.execute(index_definition)
+        logger.info(f"wrote {record_count} records to {data_table_name} from {path}")
+    connection.commit()
+
+
+def _files_by_entity(files):
+    """Map entity name to its <entity>.ndjson file, first file wins."""
+    files_by_entity = {}
+    for fn in files:
+        if fn.name.endswith('.ndjson'):
+            files_by_entity.setdefault(fn.name[:-len('.ndjson')], fn)
+    return files_by_entity
 
 
-def load_vertices(files, connection, dependency_order, project_id, mapping):
+def load_vertices(files, connection, dependency_order, project_id, mapping, max_workers=4):
     """Load files into database vertices."""
     logger.info(f"Number of files available for load: {len(files)}")
+    files_by_entity = _files_by_entity(files)
+    # vertex table for each (lower cased) class
+    table_for_entity = {}
+    for m in mapping:
+        table_for_entity.setdefault(m['dstclass'].lower(), m['dsttable'])
+        table_for_entity.setdefault(m['srcclass'].lower(), m['srctable'])
+    tasks = []
     for entity_name in dependency_order:
-        path = next(iter([fn for fn in files if str(fn).endswith(f"{entity_name}.ndjson")]), None)
+        path = files_by_entity.get(entity_name)
         if not path:
             logger.warning(f"No file found for {entity_name} skipping")
             continue
-        data_table_name = next(
-            iter(
-                set([m['dsttable'] for m in mapping if m['dstclass'].lower() == entity_name.lower()] +
-                    [m['srctable'] for m in mapping if m['srcclass'].lower() == entity_name.lower()])
-            ),
-            None)
+        data_table_name = table_for_entity.get(entity_name.lower())
         if not data_table_name:
             logger.warning(f"No mapping found for {entity_name} skipping")
             continue
-        logger.info(f"loading {path} into {data_table_name}")
-
-        columns = ['node_id', '_props', 'acl', '_sysan', 'created']
-        # Select only columns to be updated (in my case, all non-id columns)
-        # update_set = ", ".join([f"{v}=EXCLUDED.{v}" for v in ['_props', 'acl', '_sysan', 'created']])
-        update_set = ' _props=EXCLUDED._props, acl=EXCLUDED.acl, _sysan=EXCLUDED._sysan, created=EXCLUDED.created '
-
-        with connection.cursor() as cursor:
-            with open(path) as f:
-                # copy a block of records into a file like stringIO buffer
-                record_count = 0
-                for lines in chunk(f.readlines(), 1000):
-                    # Creates temporary empty table with same columns and types as
-                    # the final table
-                    cursor.execute(
-                        f"""
-                        CREATE TEMPORARY TABLE tmp_{data_table_name} (LIKE {data_table_name})
-                        ON COMMIT DROP
-                        """
-                    )
-                    buf = io.StringIO()
-                    for line in lines:
-                        record_count += 1
-                        d_ = json.loads(line)
-                        d_['object']['project_id'] = project_id
-                        obj_str = json.dumps(d_['object'])
-                        _csv = f"{d_['id']}\t{obj_str}\t{{}}\t{{}}\t{datetime.now()}".replace('\n', '\\n').replace("\\",
-                                                                                                                   "\\\\")
-                        _csv = _csv + '\n'
-                        buf.write(_csv)
-                    buf.seek(0)
-                    # efficient way to write to postgres
-                    cursor.copy_from(buf, f'tmp_{data_table_name}', sep='\t',
-                                     columns=columns)
-                    # handle conflicts
-                    cursor.execute(
-                        f"""
-                        INSERT INTO {data_table_name}({', '.join(columns)})
-                        SELECT  node_id, _props::jsonb, acl, _sysan, created FROM tmp_{data_table_name} 
-                        ON CONFLICT (node_id) DO UPDATE SET {update_set}
-                        """
-                    )
-                    logger.info(f"wrote {record_count} records to {data_table_name} from {path}")
+        tasks.append((path, data_table_name))
+
+    _load_entities(partial(_load_vertex_file, project_id=project_id), tasks, connection, max_workers)
+
+
+def _load_entities(load_file, tasks, connection, max_workers):
+    """Call load_file(connection, *task) per entity file, each worker on its own connection."""
+    if max_workers <= 1:
+        for task in tasks:
+            load_file(connection, *task)
+        return
+
+    def _worker(task):
+        # psycopg2 connections must not be shared across threads
+        worker_connection = _bulk_load_session(_connect_to_postgres())
+        try:
+            load_file(worker_connection, *task)
+        finally:
+            worker_connection.close()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the results so the first failure is raised
+        for _ in executor.map(_worker, tasks):
+            pass
+
+
+def _load_edge_file(connection, path, entity_name, edge_mappings, mapping, dependency_order, project_node_id):
+    """Upsert the relations of one entity file into its edge tables."""
+    with connection.cursor() as cursor:
+        print(path)
+        # (src_id, dst_id) pairs per edge table, flushed every EDGE_FLUSH_LIMIT pairs and at the end of the file
+        edges = defaultdict(list)
+        pair_count = 0
+        now = datetime.now(timezone.utc)
+        with open(path, 'rb') as f:
+            record_count = 0
+            for line in f:
+                d_ = orjson.loads(line)
+                relations = d_['relations']
+
+                # TODO - ensure only one id per type simplifier
+                # one relation per dst_id, the last one wins, DISTINCT ON in _flush_edges handles repeated records
+                relations = list({v['dst_id']: v for v in relations}.values())
+
+                if d_['name'] in ['ResearchStudy', 'research_study']:
+                    # link the ResearchStudy to the gen3 project
+                    relations.append({"dst_id": project_node_id, "dst_name": "Project", "label": "project"})
+                    logger.info(
+                        f"adding project relation from project({project_node_id}) to research_study{d_['id']}")
+
+                if len(relations) == 0:
+                    msg = f"No relations for {d_['name']}"
+                    if msg not in LOGGED_ALREADY:
+                        LOGGED_ALREADY.add(msg)
+                        print(msg)
+                    continue
+
+                record_count += 1
+                for relation in relations:
+
+                    # entity_name_underscore = inflection.underscore(entity_name)
+                    dst_name_camel = _camelize(relation['dst_name'])
+
+                    edge_table_mapping = edge_mappings.get((entity_name, dst_name_camel))
+                    if not edge_table_mapping and relation['dst_name'] in dependency_order:
+                        msg = f"No mapping for src {entity_name} dst {relation['dst_name']}"
+                        if msg not in LOGGED_ALREADY:
+                            logger.warning(msg)
+                            for m in mapping:
+                                logger.debug(m)
+                            LOGGED_ALREADY.add(msg)
+                        continue
+                    if not edge_table_mapping:
+                        msg = f"No mapping for src {entity_name} dst {relation['dst_name']}"
+                        if msg not in LOGGED_ALREADY:
+                            print(msg)
+                            LOGGED_ALREADY.add(msg)
+                        continue
+                    table_name = edge_table_mapping['tablename']
+                    # print(f"Mapping for src {entity_name} dst {relation['dst_name']} {table_name} {edge_table_mapping}")
+                    edges[table_name].append((d_['id'], relation['dst_id']))
+                    pair_count += 1
+
+                if pair_count >= EDGE_FLUSH_LIMIT:
+                    _flush_edges(cursor, edges, now)
+                    logger.info(f"wrote {record_count} records from {path} {entity_name}")
                     connection.commit()
-        connection.commit()
+                    edges.clear()
+                    pair_count = 0
+
+        _flush_edges(cursor, edges, now)
+        logger.info(f"wrote {record_count} records from {path} {entity_name}")
+    connection.commit()
+
+
+def _flush_edges(cursor, edges: Dict[str, List], now: datetime):
+    """Upsert buffered (src_id, dst_id) pairs into their edge tables, caller commits."""
+    columns = ['src_id', 'dst_id', 'acl', '_sysan', '_props', 'created']
+    update_set = ", ".join([f"{v}=EXCLUDED.{v}" for v in ['acl', '_sysan', '_props', 'created']])
+    created = _pg_timestamp(now)
+    for table_name, pairs in edges.items():
+        if len(pairs) < UNNEST_EDGE_LIMIT:
+            # small batches skip the temp table and COPY round trips, ids are passed as two arrays
+            cursor.execute(
+                f"""
+                INSERT INTO "{table_name}" ({', '.join(columns)})
+                SELECT DISTINCT ON (src_id, dst_id) src_id, dst_id, '{{}}'::text[], '{{}}'::jsonb, '{{}}'::jsonb, %s
+                FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS e(src_id, dst_id, n)
+                ORDER BY src_id, dst_id, n DESC
+                ON CONFLICT (src_id, dst_id) DO UPDATE SET {update_set}
+                """,
+                (now, [src_id for src_id, _ in pairs], [dst_id for _, dst_id in pairs])
+            )
+            continue
+        buf = io.BytesIO()
+        buf.write(PGCOPY_HEADER)
+        for src_id, dst_id in pairs:
+            # src_id | dst_id | acl | _sysan | _props | created |
+            buf.write(_copy_binary_row(
+                src_id.encode(),
+                dst_id.encode(),
+                EMPTY_TEXT_ARRAY,
+                EMPTY_JSONB,
+                EMPTY_JSONB,
+                created
+            ))
+        buf.write(PGCOPY_TRAILER)
+        buf.seek(0)
+        # Creates temporary empty table with same columns and types as
+        # the final table, dropped by the caller's commit
+        cursor.execute(
+            f"""
+            CREATE TEMPORARY TABLE "tmp_{table_name}" (LIKE "{table_name}")
+            ON COMMIT DROP
+            """
+        )
+        # efficient way to write to postgres, binary skips server side parsing
+        cursor.copy_expert(
+            f"""COPY "tmp_{table_name}" ({', '.join(columns)}) FROM STDIN WITH (FORMAT BINARY)""", buf
+        )
+        # handle conflicts
+        cursor.execute(
+            f"""
+            INSERT INTO "{table_name}" ({', '.join(columns)})
+            SELECT DISTINCT ON (src_id, dst_id) {', '.join(columns)} FROM "tmp_{table_name}"
+            ORDER BY src_id, dst_id, ctid DESC
+            ON CONFLICT (src_id, dst_id) DO UPDATE SET {update_set}
+            """
+        )
 
 
-def load_edges(files, connection, dependency_order, mapping, project_node_id):
+def load_edges(files, connection, dependency_order, mapping, project_node_id, max_workers=4):
     """Load files into database edges."""
     logger.info(f"Number of files available for load: {len(files)}")
+    # first mapping for each (src, dst) pair
+    edge_mappings = {}
+    for m in mapping:
+        edge_mappings.setdefault((m['srcclass'], m['dstclass']), m)
+    files_by_entity = _files_by_entity(files)
+    tasks = []
     for entity_name in dependency_order:
-        path = next(iter([fn for fn in files if str(fn).endswith(f"{entity_name}.ndjson")]), None)
+        path = files_by_entity.get(entity_name)
         if not path:
             logger.warning(f"No file found for {entity_name} skipping")
             continue
+        tasks.append((path, entity_name))
+
+    # edge tables are named by (src, dst) class, so no two entities write the same table
+    _load_entities(
+        partial(_load_edge_file, edge_mappings=edge_mappings, mapping=mapping,
+                dependency_order=dependency_order, project_node_id=project_node_id),
+        tasks, connection, max_workers
+    )
+
 
-        with connection.cursor() as cursor:
-            print(path)
-            with open(path) as f:
-                # copy a block of records into a file like stringIO buffer
-                record_count = 0
-
-                for lines in chunk(f.readlines(), 100):
-                    buffers = defaultdict(io.StringIO)
-                    for line in lines:
-                        d_ = json.loads(line)
-                        relations = d_['relations']
-
-                        # TODO - ensure only one id per type simplifier
-                        set_ = dict((v['dst_id'], v) for v in relations).values()
-                        relations = [_ for _ in set_]
-
-                        if d_['name'] in ['ResearchStudy', 'research_study']:
-                            # link the ResearchStudy to the gen3 project
-                            relations.append({"dst_id": project_node_id, "dst_name": "Project", "label": "project"})
-                            logger.info(
-                                f"adding project relation from project({project_node_id}) to research_study{d_['id']}")
-
-                        if len(relations) == 0:
-                            msg = f"No relations for {d_['name']}"
-                            if msg not in LOGGED_ALREADY:
-                                LOGGED_ALREADY.append(msg)
-                                print(msg)
-                            continue
-
-                        record_count += 1
-                        for relation in relations:
-
-                            # entity_name_underscore = inflection.underscore(entity_name)
-                            dst_name_camel = inflection.camelize(relation['dst_name'])
-
-                            edge_table_mapping = next(
-                                iter(
-                                    [
-                                        m for m in mapping
-                                        if m['srcclass'] == entity_name and m['dstclass'] == dst_name_camel
-                                    ]
-                                ),
-                                None
-                            )
-                            if not edge_table_mapping and relation['dst_name'] in dependency_order:
-                                msg = f"No mapping for src {entity_name} dst {relation['dst_name']}"
-                                if msg not in LOGGED_ALREADY:
-                                    logger.warning(msg)
-                                    for m in mapping:
-                                        logger.debug(m)
-                                    LOGGED_ALREADY.append(msg)
-                                continue
-                            if not edge_table_mapping:
-                                msg = f"No mapping for src {entity_name} dst {relation['dst_name']}"
-                                if msg not in LOGGED_ALREADY:
-                                    print(msg)
-                                    LOGGED_ALREADY.append(msg)
-                                continue
-                            table_name = edge_table_mapping['tablename']
-                            # print(f"Mapping for src {entity_name} dst {relation['dst_name']} {table_name} {edge_table_mapping}")
-                            buf = buffers[table_name]
-                            # src_id | dst_id | acl | _sysan | _props | created |
-                            buf.write(f"{d_['id']}|{relation['dst_id']}|{{}}|{{}}|{{}}|{datetime.now()}\n")
-                    for table_name, buf in buffers.items():
-                        buf.seek(0)
-                        # Creates temporary empty table with same columns and types as
-                        # the final table
-                        cursor.execute(
-                            f"""
-                            CREATE TEMPORARY TABLE "tmp_{table_name}" (LIKE "{table_name}")
-                            ON COMMIT DROP
-                            """
-                        )
-
-                        columns = ['src_id', 'dst_id', 'acl', '_sysan', '_props', 'created']
-                        update_set = ", ".join([f"{v}=EXCLUDED.{v}" for v in ['acl', '_sysan', '_props', 'created']])
-                        # efficient way to write to postgres
-                        cursor.copy_from(buf, f"tmp_{table_name}", sep='|',
-                                         columns=columns)
-                        # handle conflicts
-                        cursor.execute(
-                            f"""
-                            INSERT INTO "{table_name}" ({', '.join(columns)})
-                            SELECT  {', '.join(columns)} FROM "tmp_{table_name}" 
-                            ON CONFLICT (src_id, dst_id) DO UPDATE SET {update_set}
-                            """
-                        )
-                        logger.info(
-                            f"wrote {record_count} records to {table_name} from {path} {entity_name} {relation['dst_name']}")
-                        connection.commit()
-        connection.commit()
+def _program_node_id(cur, program):
+    """node_id of the named program, or None."""
+    cur.execute("select node_id from \"node_program\" where _props->>'name' = %s limit 1;", (program,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _project_node_id(cur, project_code):
+    """node_id of the project with code, or None."""
+    cur.execute("select node_id from \"node_project\" where _props->>'code' = %s limit 1;", (project_code,))
+    row = cur.fetchone()
+    return row[0] if row else None
 
 
 def meta_upload(source_path, program, project, credentials_file, silent, dictionary_path, config_path,
@@ -256,19 +429,12 @@ def meta_upload(source_path, program, project, credentials_file, silent, diction
     conn = _connect_to_postgres()
     assert conn
     logger.info("Connected to postgres")
+    _bulk_load_session(conn)
 
     # check program/project exist
     cur = conn.cursor()
-    cur.execute("select node_id, _props from \"node_program\";")
-    programs = cur.fetchall()
-    programs = [{'node_id': p[0], '_props': p[1]} for p in programs]
-    _ = next(iter([p for p in programs if p['_props']['name'] == program]), None)
-    assert _, f"{program} not found in node_program table"
-    cur.execute("select node_id, _props from \"node_project\";")
-    projects = cur.fetchall()
-    projects = [{'node_id': p[0], '_props': p[1]} for p in projects]
-    project_code = project
-    project_node_id = next(iter([p['node_id'] for p in projects if p['_props']['code'] == project_code]), None)
+    assert _program_node_id(cur, program), f"{program} not found in node_program table"
+    project_node_id = _project_node_id(cur, project)
     assert project_node_id, f"{project} not found in node_project"
     project_id = f"{program}-{project}"
     logger.info(f"Program and project exist: {project_id} {project_node_id}")
@@ -282,7 +448,7 @@ def meta_upload(source_path, program, project, credentials_file, silent, diction
     # check the mappings
     dictionary_dir = dictionary_path if 'http' not in dictionary_path else None
     dictionary_url = dictionary_path if 'http' in dictionary_path else None
-    mappings = [mapping for mapping in _table_mappings(dictionary_dir, dictionary_url)]
+    mappings = list(_table_mappings(dictionary_dir, dictionary_url))
 
     # load the files
     logger.info("Loading vertices")
@@ -307,12 +473,8 @@ def ensure_project(program, project) -> bool:
 
     # check program/project exist
     cur = conn.cursor()
-    cur.execute("select node_id, _props from \"node_program\";")
-    programs = cur.fetchall()
-    programs = [{'node_id': p[0], '_props': p[1]} for p in programs]
-    _ = next(iter([p for p in programs if p['_props']['name'] == program]), None)
-    program_node_id = None
-    if not _:  # program does not exist
+    program_node_id = _program_node_id(cur, program)
+    if not program_node_id:  # program does not exist
         logger.info(f"Program {program} does not exist")
         program_node_id = str(uuid.uuid5(PROGRAM_SEED, program))
         cur.execute(
@@ -322,14 +484,10 @@ def ensure_project(program, project) -> bool:
         conn.commit()
         logger.info(f"Created Program {program}: {program_node_id}")
     else:
-        program_node_id = _['node_id']
         logger.info(f"Program {program} exists: {program_node_id}")
 
-    cur.execute("select node_id, _props from \"node_project\";")
-    projects = cur.fetchall()
-    projects = [{'node_id': p[0], '_props': p[1]} for p in projects]
     project_code = project
-    project_node_id = next(iter([p['node_id'] for p in projects if p['_props']['code'] == project_code]), None)
+    project_node_id = _project_node_id(cur, project_code)
     if not project_node_id:  # project does not exist
         logger.info(f"Project {project_code} does not exist")
         project_node_id = str(uuid.uuid5(PROJECT_SEED, project))
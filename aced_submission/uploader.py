@@ -1,32 +1,61 @@
 #!/usr/bin/env python3
 import datetime
+import hashlib
 import json
 import logging
+import os
 import pathlib
+import re
 import sys
+import threading
 import urllib
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from dataclasses import dataclass
-from itertools import islice
-from multiprocessing.pool import Pool
-from time import sleep
+from functools import lru_cache, partial
 from typing import Iterator
 
 import click
 import jwt
 import requests
+from requests.adapters import HTTPAdapter
 from gen3.auth import Gen3Auth
 from gen3.file import Gen3File
 from gen3.index import Gen3Index
 from orjson import orjson
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
 from aced_submission import NaturalOrderGroup
+from aced_submission.util import chunk, read_resources
 
 logger = logging.getLogger(__name__)
 
 LOGGED_ALREADY = set({})
 
+# per upload thread: gen3_services key:credentials_file (file_client, index_client), s3_session for signed urls
+_WORKER = threading.local()
+
+# upload state lines written between fsyncs of state.ndjson
+STATE_FSYNC_INTERVAL = 100
+
+# files larger than this are uploaded in MULTIPART_CHUNK_SIZE parts, MULTIPART_WORKERS at a time across all files
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+MULTIPART_WORKERS = 8
+# (connect, read) seconds for fence multipart calls and part PUTs
+MULTIPART_TIMEOUT = (10, 300)
+
+# one part pool shared by all upload threads, parts read but not yet uploaded are capped across files
+_PART_EXECUTOR = ThreadPoolExecutor(max_workers=MULTIPART_WORKERS, thread_name_prefix='multipart')
+_PART_SLOTS = threading.BoundedSemaphore(MULTIPART_WORKERS * 2)
+
+MD5_EXTENSION_URL = "http://aced-idp.org/fhir/StructureDefinition/md5"
+SOURCE_PATH_EXTENSION_URL = "http://aced-idp.org/fhir/StructureDefinition/source_path"
+
+# leading file:// schemes, './' and '/' of attachment urls and source paths, dot files and '../' are kept
+URL_PREFIXES = re.compile(r'^(?:file://|\./|/)+')
+
 ACED_CODEABLE_CONCEPT = uuid.uuid3(uuid.NAMESPACE_DNS, 'aced.ipd/CodeableConcept')
 ACED_NAMESPACE = uuid.uuid3(uuid.NAMESPACE_DNS, 'aced-ipd.org')
 
@@ -42,10 +71,9 @@ class UploadResult:
     """On error."""
 
 
-def _chunk(arr_range, arr_size):
-    """Iterate in chunks."""
-    arr_range = iter(arr_range)
-    return iter(lambda: tuple(islice(arr_range, arr_size)), ())
+def _strip_url_prefixes(url: str) -> str:
+    """Relative path of a file url or path, leading file:// schemes, './' and '/' removed."""
+    return URL_PREFIXES.sub('', url)
 
 
 @click.group(cls=NaturalOrderGroup)
@@ -54,8 +82,9 @@ def files():
     pass
 
 
+@lru_cache(maxsize=8)
 def extract_endpoint(gen3_credentials_file):
-    """Get base url of jwt issuer claim."""
+    """Get base url of jwt issuer claim, once per credentials file."""
     with open(gen3_credentials_file) as fp:
         api_key = json.load(fp)['api_key']
         claims = jwt.decode(api_key, options={"verify_signature": False})
@@ -65,35 +94,40 @@ def extract_endpoint(gen3_credentials_file):
 
 def _upload_document_reference(document_reference: dict, bucket_name: str,
                                program: str, project: str, duplicate_check: bool, credentials_file: str,
-                               source_path: str) -> UploadResult:
-    """Write a single document reference to indexd and upload file."""
+                               source_path: str, existing_records: dict = None, file_name: str = None) -> UploadResult:
+    """Write a single document reference to indexd and upload file, file_name if already resolved and checked."""
 
     try:
         start = datetime.datetime.now()
         # print(('starting', document_reference['id'], start.isoformat()))
 
-        file_client, index_client = _gen3_services(credentials_file)
+        file_client, index_client, auth = _gen3_services(credentials_file)
 
         attachment, md5sum, source_path_extension = _extract_extensions(document_reference)
 
-        source_path = _extract_source_path(attachment, source_path, source_path_extension)
-
-        file_name = source_path.lstrip('./').lstrip('file:///')
-        object_name = attachment['url'].lstrip('./').lstrip('file:///')
+        if file_name is None:
+            file_name = _resolve_file_name(document_reference, source_path)
+            assert pathlib.Path(file_name).exists(), f"{file_name} does not exist"
+        object_name = _strip_url_prefixes(attachment['url'])
 
         metadata = _update_indexd(attachment, bucket_name, document_reference, duplicate_check, index_client, md5sum,
-                                  object_name, program, project)
-
-        # create a record in gen3 using document_reference's id as guid, get a signed url
-        # SYNC
+                                  object_name, program, project, existing_records)
 
-        document = file_client.upload_file_to_guid(guid=document_reference['id'], file_name=object_name, bucket=bucket_name)
-        assert 'url' in document, document
-        signed_url = urllib.parse.unquote(document['url'])
         file_name = pathlib.Path(file_name)
-        assert file_name.exists(), f"{file_name} does not exist"
 
-        _upload_file_to_signed_url(file_name, md5sum, metadata, signed_url)
+        if attachment['size'] > MULTIPART_THRESHOLD:
+            # large files are sent as parts, in parallel, a failed part is retried on its own
+            _multipart_upload(auth, document_reference['id'], object_name, bucket_name, file_name, md5sum,
+                              attachment['size'])
+        else:
+            # create a record in gen3 using document_reference's id as guid, get a signed url
+            # SYNC
+
+            document = file_client.upload_file_to_guid(guid=document_reference['id'], file_name=object_name, bucket=bucket_name)
+            assert 'url' in document, document
+            signed_url = urllib.parse.unquote(document['url'])
+
+            _upload_file_to_signed_url(file_name, md5sum, metadata, signed_url)
 
         end = datetime.datetime.now()
         # print(('complete', document_reference['id'], end.isoformat(), end-start, attachment["size"]))
@@ -112,6 +146,44 @@ def _read_in_chunks(file_object, chunk_size):
         yield data
 
 
+class _HashingReader:
+    """File object that hashes the bytes read from it, sized so requests sends a Content-Length."""
+
+    def __init__(self, fp, size: int):
+        self._fp = fp
+        self._size = size
+        self.md5 = hashlib.md5()
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=-1) -> bytes:
+        data = self._fp.read(size)
+        self.md5.update(data)
+        return data
+
+    def tell(self) -> int:
+        return self._fp.tell()
+
+    def seek(self, offset, whence=0) -> int:
+        # a retry rewinds the body, start the digest over
+        self.md5 = hashlib.md5()
+        return self._fp.seek(offset, whence)
+
+
+def _s3_session() -> requests.Session:
+    """Keep-alive session for signed url uploads, once per upload thread."""
+    session = getattr(_WORKER, 's3_session', None)
+    if session is None:
+        session = _WORKER.s3_session = requests.Session()
+        # PUT is idempotent, urllib3 rewinds the file body before a retry
+        retry = Retry(total=3, read=False, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return session
+
+
 def _upload_file_to_signed_url(file_name, md5sum, metadata, signed_url):
     """Upload file """
 
@@ -126,13 +198,103 @@ def _upload_file_to_signed_url(file_name, md5sum, metadata, signed_url):
 
     with open(file_name, 'rb') as fp:
         # SYNC
-        response = requests.put(signed_url, data=fp)
+        # the file object is streamed from disk with a Content-Length, S3 rejects chunked PUTs to a signed url
+        reader = _HashingReader(fp, os.fstat(fp.fileno()).st_size)
+        response = _s3_session().put(signed_url, data=reader)
         response_text = response.text
         assert response.status_code == 200, (signed_url, response_text)
+        # the md5 of the bytes sent, hashed in the same pass as the upload
+        assert reader.md5.hexdigest() == md5sum, f"md5 mismatch {file_name} uploaded {reader.md5.hexdigest()} expected {md5sum}"
+
+
+@lru_cache(maxsize=1)
+def _fence_session() -> requests.Session:
+    """Keep-alive session for fence multipart calls, shared by all upload threads."""
+    session = requests.Session()
+    # POSTs are only retried when the connection could not be made
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MULTIPART_WORKERS,
+                          max_retries=Retry(total=3, backoff_factor=0.3))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _fence_post(auth: Gen3Auth, path: str, body: dict) -> dict:
+    """POST to a fence /data endpoint with the upload's credentials."""
+    response = _fence_session().post(f"{auth.endpoint}/user/data/{path}", json=body, auth=auth,
+                                     timeout=MULTIPART_TIMEOUT)
+    assert response.status_code in [200, 201], (path, response.text)
+    return response.json() if response.content else {}
+
+
+def _upload_part(auth: Gen3Auth, key: str, upload_id: str, bucket_name: str, part_number: int, data: bytes) -> dict:
+    """Upload one part to its own signed url."""
+    presigned = _fence_post(auth, 'multipart/upload',
+                            {'key': key, 'uploadId': upload_id, 'partNumber': part_number, 'bucket': bucket_name})
+    response = _s3_session().put(presigned['presigned_url'], data=data, timeout=MULTIPART_TIMEOUT)
+    assert response.status_code == 200, (key, part_number, response.text)
+    return {'PartNumber': part_number, 'ETag': response.headers['ETag'].strip('"')}
+
+
+def _upload_parts(auth: Gen3Auth, key: str, upload_id: str, bucket_name: str, file_name: pathlib.Path,
+                  part_size: int) -> (list, str):
+    """Read and hash parts in order, upload them on the shared part pool, return parts and md5."""
+    md5 = hashlib.md5()
+    futures = []
+    failed = threading.Event()
+
+    def _part_done(future):
+        _PART_SLOTS.release()
+        if future.cancelled() or future.exception():
+            failed.set()
+
+    try:
+        with open(file_name, 'rb') as fp:
+            for part_number in range(1, 10001):
+                # wait for a slot before reading, bounds the parts held in memory
+                _PART_SLOTS.acquire()
+                data = b'' if failed.is_set() else fp.read(part_size)
+                if not data:
+                    _PART_SLOTS.release()
+                    break
+                md5.update(data)
+                future = _PART_EXECUTOR.submit(_upload_part, auth, key, upload_id, bucket_name, part_number, data)
+                future.add_done_callback(_part_done)
+                futures.append(future)
+                # the pool holds the part until it is sent, don't keep it alive while waiting for a slot
+                del data
+        return [_.result() for _ in futures], md5.hexdigest()
+    finally:
+        if failed.is_set():
+            # don't send parts of an upload that will be aborted
+            for future in futures:
+                future.cancel()
+        wait(futures)
+
+
+def _multipart_upload(auth: Gen3Auth, guid: str, object_name: str, bucket_name: str, file_name: pathlib.Path,
+                      md5sum: str, size: int):
+    """Upload file to guid with fence's multipart api, parts are read and hashed in order, uploaded in parallel."""
+    upload = _fence_post(auth, 'multipart/init', {'file_name': object_name, 'guid': guid, 'bucket': bucket_name})
+    key = f"{upload['guid']}/{object_name}"
+    # S3 allows at most 10,000 parts
+    part_size = max(MULTIPART_CHUNK_SIZE, -(-size // 10000))
+    try:
+        parts, uploaded_md5 = _upload_parts(auth, key, upload['uploadId'], bucket_name, file_name, part_size)
+        assert uploaded_md5 == md5sum, f"md5 mismatch {file_name} uploaded {uploaded_md5} expected {md5sum}"
+    except Exception:
+        # don't leave the uploaded parts in the bucket
+        try:
+            _fence_post(auth, 'multipart/abort', {'key': key, 'uploadId': upload['uploadId'], 'bucket': bucket_name})
+        except Exception as e:  # noqa
+            logger.warning(f"Could not abort multipart upload {key} {upload['uploadId']}: {e}")
+        raise
+    _fence_post(auth, 'multipart/complete',
+                {'key': key, 'uploadId': upload['uploadId'], 'parts': parts, 'bucket': bucket_name})
 
 
 def _update_indexd(attachment, bucket_name, document_reference, duplicate_check, index_client, md5sum, object_name,
-                   program, project):
+                   program, project, existing_records=None):
     hashes = {'md5': md5sum}
     assert 'id' in document_reference, document_reference
     guid = document_reference['id']
@@ -146,10 +308,12 @@ def _update_indexd(attachment, bucket_name, document_reference, duplicate_check,
     existing_record = None
     s3_url = f"s3://{bucket_name}/{guid}/{object_name}"
     if duplicate_check:
-        try:
+        if existing_records is not None:
+            # prefetched by _existing_indexd_records
+            existing_record = existing_records.get(guid)
+        else:
+            # None when indexd has no record, other errors fail this upload
             existing_record = index_client.get_record(guid=document_reference["id"])
-        except Exception: # noqa
-            pass
         if existing_record:
             skip_delete = all([
                 existing_record['hashes']['md5'] == md5sum,
@@ -178,33 +342,59 @@ def _update_indexd(attachment, bucket_name, document_reference, duplicate_check,
     return metadata
 
 
+def _existing_indexd_records(credentials_file: str, guids: set, batch_size: int = 100) -> dict:
+    """Fetch indexd records for guids, a bulk request per batch, key:did."""
+    _, index_client, _ = _gen3_services(credentials_file)
+    existing_records = {}
+    for batch in chunk(sorted(guids), batch_size):
+        for record in index_client.get_records(list(batch)) or []:
+            existing_records[record['did']] = record
+    return existing_records
+
+
 def _extract_source_path(attachment, source_path, source_path_extension) -> str:
     if source_path:
-        source_path = pathlib.Path(source_path)
-        assert source_path.is_dir(), f"Path is not a directory {source_path}"
-        source_path = source_path / attachment['url'].lstrip('./').lstrip('file:///')
+        source_path = pathlib.Path(source_path) / _strip_url_prefixes(attachment['url'])
         source_path = str(source_path)
     else:
         if len(source_path_extension) == 1:  # "Missing source_path extension."
             source_path = source_path_extension[0]['valueUrl']
         else:
-            source_path = attachment['url'].lstrip('./').lstrip('file:///')
+            source_path = _strip_url_prefixes(attachment['url'])
     return source_path
 
 
+def _resolve_file_name(document_reference, source_path) -> str:
+    """Local path of the file attached to document_reference."""
+    attachment, _, source_path_extension = _extract_extensions(document_reference)
+    return _strip_url_prefixes(_extract_source_path(attachment, source_path, source_path_extension))
+
+
 def _extract_extensions(document_reference):
     """Extract useful data from document_reference."""
     attachment = document_reference['content'][0]['attachment']
-    md5_extension = [_ for _ in attachment['extension'] if
-                     _['url'] == "http://aced-idp.org/fhir/StructureDefinition/md5"]
+    # key:url extensions, a single pass over the attachment's extensions
+    extensions = {}
+    for _ in attachment['extension']:
+        extensions.setdefault(_['url'], []).append(_)
+    md5_extension = extensions.get(MD5_EXTENSION_URL, [])
     assert len(md5_extension) == 1, "Missing MD5 extension."
     md5sum = md5_extension[0]['valueString']
-    source_path_extension = [_ for _ in attachment['extension'] if
-                             _['url'] == "http://aced-idp.org/fhir/StructureDefinition/source_path"]
+    source_path_extension = extensions.get(SOURCE_PATH_EXTENSION_URL, [])
     return attachment, md5sum, source_path_extension
 
 
-def _gen3_services(credentials_file: str) -> (Gen3File, Gen3Index):
+def _gen3_services(credentials_file: str) -> (Gen3File, Gen3Index, Gen3Auth):
+    """Create Gen3 Services, once per credentials file in each upload thread."""
+    services = getattr(_WORKER, 'gen3_services', None)
+    if services is None:
+        services = _WORKER.gen3_services = {}
+    if credentials_file not in services:
+        services[credentials_file] = _build_gen3_services(credentials_file)
+    return services[credentials_file]
+
+
+def _build_gen3_services(credentials_file: str) -> (Gen3File, Gen3Index, Gen3Auth):
     """Create Gen3 Services."""
     credentials_file = str(pathlib.Path(credentials_file).expanduser())
     endpoint = extract_endpoint(credentials_file)
@@ -212,27 +402,33 @@ def _gen3_services(credentials_file: str) -> (Gen3File, Gen3Index):
     auth = Gen3Auth(endpoint, refresh_file=credentials_file)
     file_client = Gen3File(endpoint, auth)
     index_client = Gen3Index(endpoint, auth)
-    return file_client, index_client
+    return file_client, index_client, auth
 
 
 def document_reference_reader(document_reference_path) -> Iterator[dict]:
-    """Read DocumentReference.ndjson file or bundle."""
-    if 'ndjson' in document_reference_path:
-        with open(document_reference_path) as fp:
-            for _ in fp.readlines():
-                yield orjson.loads(_)
+    """Read DocumentReference.ndjson file or bundles in a directory."""
+    document_reference_path = pathlib.Path(document_reference_path)
+    if document_reference_path.is_file():
+        resources = read_resources(document_reference_path.parent, document_reference_path.name)
     else:
-        document_reference_path = pathlib.Path(document_reference_path)
-        for input_file in document_reference_path.glob('*.json'):
-            with open(input_file, "rb") as fp:
-                bundle_ = orjson.loads(fp.read())
-                if 'entry' not in bundle_:
-                    print(f"No 'entry' in bundle {input_file} ")
-                    break
-            for entry in bundle_['entry']:
-                resource = entry['resource']
-                if resource['resourceType'] == 'DocumentReference':
-                    yield resource
+        resources = read_resources(document_reference_path, '*.json')
+    for resource in resources:
+        if resource['resourceType'] == 'DocumentReference':
+            yield resource
+
+
+def _already_uploaded(state_file: pathlib.Path) -> set:
+    """Ids of document references uploaded by earlier runs, from per upload and older summary lines."""
+    already_uploaded = set()
+    with open(state_file, "rb") as fp:
+        for _ in fp:
+            state = orjson.loads(_)
+            if 'completed' in state:
+                # summary line written by earlier versions
+                already_uploaded.update(state['completed'])
+            elif state['ok']:
+                already_uploaded.add(state['id'])
+    return already_uploaded
 
 
 @files.command(name='upload')
@@ -250,8 +446,8 @@ def document_reference_reader(document_reference_path) -> Iterator[dict]:
               help='API credentials file downloaded from gen3 profile.')
 @click.option('--duplicate_check', default=False, is_flag=True, show_default=True,
               help="Check for existing indexd records")
-@click.option('--worker_count', default=10, show_default=True,
-              help="Number of worker processes")
+@click.option('--worker_count', default=32, show_default=True,
+              help="Number of upload threads")
 @click.option('--silent', default=False, is_flag=True, show_default=True,
               help="No progress bar, or other output")
 @click.option('--state_dir', default='~/.gen3/aced-uploader', show_default=True,
@@ -277,117 +473,100 @@ def upload_document_reference(bucket_name, document_reference_path, source_path,
     # key:document_reference.id  of failed file transfers
     exceptions = {}
 
-    # for unhandled exceptions: map multiprocessing tasks results to document_reference
-    # keyed by result
-    document_reference_lookup = {}
-
     # progress bar control
     document_references_size = 0
-    # loop control
-    document_references_length = 0
 
     already_uploaded = set()
     if not ignore_state and state_file.exists():
-        with open(state_file, "rb") as fp:
-            for _ in fp.readlines():
-                state = orjson.loads(_)
-                already_uploaded.update([_ for _ in state['completed']])
+        already_uploaded = _already_uploaded(state_file)
 
+    # document references to upload, the file is read once
+    if source_path:
+        assert pathlib.Path(source_path).is_dir(), f"Path is not a directory {source_path}"
+
+    # (document reference, local file) to upload, the file is read once, missing local files fail before any request
+    document_references = []
     for _ in document_reference_reader(document_reference_path):
         if _['id'] not in already_uploaded:
             incomplete.add(_['id'])
-            document_references_size += _['content'][0]['attachment']['size']
-            document_references_length += 1
+            try:
+                file_name = _resolve_file_name(_, source_path)
+                os.stat(file_name)
+                size = _['content'][0]['attachment']['size']
+            except Exception as e:  # noqa
+                # a malformed or missing file fails this upload, not the run
+                exceptions[_['id']] = {
+                        'exception': str(e),
+                        'document_reference': {
+                            'id': _
+                        }
+                    }
+                continue
+            document_references_size += size
+            document_references.append((_, file_name))
         else:
             if not silent:
                 print(f"{_['id']} already uploaded, skipping", file=sys.stderr)
 
-    # re-open file, process it a chunk at a time
-    with Pool(processes=worker_count) as pool:
-        results = []
-        for document_reference in document_reference_reader(document_reference_path):
-            if document_reference['id'] in already_uploaded:
-                continue
-            result = pool.apply_async(
-                func=_upload_document_reference,
-                args=(
-                    document_reference,
-                    bucket_name,
-                    program,
-                    project,
-                    duplicate_check,
-                    credentials_file,
-                    source_path
-                )
-            )
-            results.append(result)
-            document_reference_lookup[id(result)] = document_reference['id']
-
-        # close the process pool
-        pool.close()
-
-        # poll the results every sec.
-        with tqdm(total=document_references_size, unit='B', disable=silent,
+    # look up existing indexd records in bulk, rather than one GET per upload
+    existing_records = _existing_indexd_records(credentials_file, incomplete) if duplicate_check else None
+
+    upload = partial(
+        _upload_document_reference,
+        bucket_name=bucket_name,
+        program=program,
+        project=project,
+        duplicate_check=duplicate_check,
+        credentials_file=credentials_file,
+        source_path=source_path,
+        existing_records=existing_records
+    )
+    # results stream back as each upload completes
+    # uploads are network bound, threads share the process and release the GIL while waiting
+    with ThreadPoolExecutor(max_workers=worker_count) as executor, open(state_file, "a+b") as state_fp:
+        futures = [executor.submit(upload, _, file_name=file_name) for _, file_name in document_references]
+        # document references whose local file could not be resolved were never submitted
+        for document_reference_id, exception in exceptions.items():
+            state_fp.write(orjson.dumps(
+                {
+                    'id': document_reference_id,
+                    'ok': False,
+                    'timestamp': datetime.datetime.now().isoformat(),
+                    'exception': exception['exception']
+                },
+                option=orjson.OPT_APPEND_NEWLINE
+            ))
+        # redraws are rate limited by tqdm, completions are not paced
+        with tqdm(total=document_references_size, unit='B', disable=silent, mininterval=0.5,
                   unit_scale=True, unit_divisor=1024) as pbar:
-            while True:
-                results_to_remove = []
-                for record in results:
-                    if record.ready() and record.successful():
-                        r = record.get()
-                        # print(f'ready and successful {id(r)}')
-                        if r.exception:
-                            exceptions[r.document_reference['id']] = {
-                                    'exception': str(r.exception),
-                                    'document_reference': {
-                                        'id': r.document_reference
-                                    }
-                                }
-                        elif r.document_reference['id'] not in completed:
-                            completed.add(r.document_reference['id'])
-                            incomplete.remove(r.document_reference['id'])
-
-                        results_to_remove.append(record)
-                        document_references_length = document_references_length - 1
-                        pbar.set_postfix(file=f"{r.document_reference['id'][-6:]}", elapsed=f"{r.elapsed}")
-                        pbar.update(r.document_reference['content'][0]['attachment']['size'])
-                        sleep(.1)  # give screen a chance to refresh
-
-                    if record.ready() and not record.successful():
-                        print('record.ready() and not record.successful()')
-                        # capture exception, we shouldn't get here as all exception should be caught
-                        document_reference_id = document_reference_lookup[id(record)]
-                        try:
-                            record.get()
-                        except Exception as e:  # noqa
-                            if document_reference_id not in exceptions:
-                                exceptions[document_reference_id] = {
-                                    'exception': str(e),
-                                    'document_reference': {
-                                        'id': document_reference_id
-                                    }
-                                }
-                                document_references_length = document_references_length - 1
-                                # print('not successful', document_references_length, e)
-
-                if document_references_length == 0:
-                    break
-
-                # print(f'sleeping(1) document_references_length: {document_references_length}')
-                sleep(1)
-
-                # using list comprehension to cull processed results
-                results = [_ for _ in results if _ not in results_to_remove]
-
-        with open(state_file, "a+b") as fp:
-            fp.write(orjson.dumps(
-                    {
-                        'timestamp': datetime.datetime.now().isoformat(),
-                        'completed': [_ for _ in completed],
-                        'incomplete': [_ for _ in incomplete],
-                        'exceptions': exceptions
-                    },
-                    option=orjson.OPT_APPEND_NEWLINE
-                ))
+            for state_count, future in enumerate(as_completed(futures), start=1):
+                r = future.result()
+                # one state line per transfer as it completes, so an interrupted run can resume
+                state = {
+                    'id': r.document_reference['id'],
+                    'ok': r.exception is None,
+                    'timestamp': datetime.datetime.now().isoformat()
+                }
+                if r.exception:
+                    exceptions[r.document_reference['id']] = {
+                            'exception': str(r.exception),
+                            'document_reference': {
+                                'id': r.document_reference
+                            }
+                        }
+                    state['exception'] = str(r.exception)
+                elif r.document_reference['id'] not in completed:
+                    completed.add(r.document_reference['id'])
+                    incomplete.remove(r.document_reference['id'])
+                state_fp.write(orjson.dumps(state, option=orjson.OPT_APPEND_NEWLINE))
+                state_fp.flush()
+                if state_count % STATE_FSYNC_INTERVAL == 0:
+                    os.fsync(state_fp.fileno())
+
+                pbar.set_postfix(file=f"{r.document_reference['id'][-6:]}", elapsed=f"{r.elapsed}")
+                pbar.update(r.document_reference['content'][0]['attachment']['size'])
+
+        os.fsync(state_fp.fileno())
 
         if not silent:
             print(f"Wrote state to {state_file}", file=sys.stderr)
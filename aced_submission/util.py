@@ -1,11 +1,19 @@
 import gzip
 import importlib
-import io
+import mmap
+import os
 import pathlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, Iterator
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Iterable, Iterator
 
 import orjson
+import requests
+from dictionaryutils import DataDictionary
 from fhir.resources.fhirresourcemodel import FHIRResourceModel
 from pydantic import ValidationError
 import logging
@@ -14,6 +22,9 @@ FHIR_CLASSES = importlib.import_module('fhir.resources')
 
 logger = logging.getLogger(__name__)
 
+# ndjson files larger than this are memory mapped
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
 
 @dataclass
 class ParseResult:
@@ -44,12 +55,82 @@ def parse_obj(resource: Dict, validate=True) -> ParseResult:
         return ParseResult(resource=None, exception=e, path=None, resource_id=resource.get('id', None))
 
 
+def read_ndjson(path: str) -> Iterator[Dict]:
+    """Read ndjson file, load json line by line."""
+    with open(path, 'rb') as jsonfile:
+        if os.fstat(jsonfile.fileno()).st_size == 0:
+            return  # can't mmap an empty file
+        # parse lines straight out of the page cache, no copies through a read buffer
+        with mmap.mmap(jsonfile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            start = 0
+            end = mm.find(b'\n', start)
+            while end != -1:
+                yield orjson.loads(mm[start:end])
+                start = end + 1
+                end = mm.find(b'\n', start)
+            if start < len(mm):
+                # last line has no trailing newline
+                yield orjson.loads(mm[start:])
+
+
+try:
+    # python 3.12+, batches are assembled in C
+    from itertools import batched as chunk
+except ImportError:
+    def chunk(arr_range, arr_size):
+        """Iterate in chunks."""
+        arr_range = iter(arr_range)
+        return iter(lambda: tuple(islice(arr_range, arr_size)), ())
+
+
+def prefetch(iterable: Iterable, maxsize: int = 1024) -> Iterator:
+    """Drain iterable on a worker thread, yield its items from a bounded queue."""
+    buffer = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def _produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    break
+                buffer.put(item)
+        finally:
+            buffer.put(done)
+
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(_produce)
+        item = None
+        try:
+            item = buffer.get()
+            while item is not done:
+                yield item
+                item = buffer.get()
+        finally:
+            if item is not done:
+                # consumer quit early, unblock the producer so the executor can shut down
+                stop.set()
+                while buffer.get() is not done:
+                    pass
+        future.result()
+
+
+@lru_cache(maxsize=8)
+def load_schema(schema_path: str) -> Dict:
+    """Gen3 schema from url or local file, fetched and parsed once per path."""
+    if 'http' in schema_path:
+        return requests.get(schema_path).json()
+    return DataDictionary(local_file=schema_path).schema
+
+
 def _is_ndjson(file_path: pathlib.Path) -> bool:
     """Open file, read all lines as json."""
     fp = _to_file(file_path)
     try:
         with fp:
-            for line in fp.readlines():
+            for line in fp:
                 orjson.loads(line)
                 break
         return True
@@ -60,7 +141,8 @@ def _is_ndjson(file_path: pathlib.Path) -> bool:
 def _to_file(file_path):
     """Open file appropriately."""
     if file_path.name.endswith('gz'):
-        fp = io.TextIOWrapper(io.BufferedReader(gzip.GzipFile(file_path)))  # noqa
+        # binary like the plain file, orjson parses the bytes without a decode
+        fp = gzip.open(file_path, "rb")
     else:
         fp = open(file_path, "rb")
     return fp
@@ -103,9 +185,8 @@ def _entry_iterator(parse_result: ParseResult) -> Iterator[ParseResult]:
     pass
 
 
-def directory_reader(directory_path: pathlib.Path, pattern: str = '*.*', validate=True) -> Iterator[ParseResult]:
-    """Extract FHIR resources from directory"""
-
+def _json_files(directory_path: pathlib.Path, pattern: str) -> Iterator[pathlib.Path]:
+    """The json, ndjson and gzipped files in directory matching pattern."""
     assert directory_path.is_dir(), f"{directory_path.name} is not a directory"
 
     input_files = [_ for _ in directory_path.glob(pattern) if _is_json_file(_.name)]
@@ -113,26 +194,46 @@ def directory_reader(directory_path: pathlib.Path, pattern: str = '*.*', validat
         logger.info(input_file)
         if not input_file.is_file():
             continue
-        is_ndjson = _is_ndjson(input_file)
-        fp = _to_file(input_file)
-        with fp:
-            if is_ndjson:
-                offset = 0
-                for line in fp.readlines():
-                    parse_result = parse_obj(orjson.loads(line), validate)
-                    parse_result.path = input_file
-                    parse_result.offset = offset
-                    for _ in _entry_iterator(parse_result):
-                        # print(_.offset, 'is_ndjson', input_file, parse_result.resource.id, parse_result.resource.resource_type)
-                        yield _
-                    offset += 1
+        yield input_file
+
+
+def _read_json_file(input_file: pathlib.Path) -> Iterator[Dict]:
+    """Top level json objects of a file, one per ndjson line or the whole json document."""
+    is_ndjson = _is_ndjson(input_file)
+    if is_ndjson and not input_file.name.endswith('gz') and input_file.stat().st_size > MMAP_THRESHOLD:
+        # large files are parsed from a memory map, without a read syscall per line
+        yield from read_ndjson(input_file)
+        return
+    fp = _to_file(input_file)
+    with fp:
+        if is_ndjson:
+            for line in fp:
+                yield orjson.loads(line)
+        else:
+            # look for json bundles
+            yield orjson.loads(fp.read())
+
+
+def read_resources(directory_path: pathlib.Path, pattern: str = '*.*') -> Iterator[Dict]:
+    """Extract FHIR resource dicts from directory, without validation, bundle entries are unpacked."""
+    for input_file in _json_files(directory_path, pattern):
+        for resource in _read_json_file(input_file):
+            if resource.get('resourceType', None) == 'Bundle':
+                for entry in resource.get('entry', None) or []:
+                    if 'resource' in entry:
+                        yield entry['resource']
             else:
-                # look for json bundles
-                _ = orjson.loads(fp.read())
-                # not a bundle
-                parse_result = parse_obj(_, validate)
-                parse_result.path = input_file
-                parse_result.offset = 0
-                for _ in _entry_iterator(parse_result):
-                    yield _
-                continue
+                yield resource
+
+
+def directory_reader(directory_path: pathlib.Path, pattern: str = '*.*', validate=True) -> Iterator[ParseResult]:
+    """Extract FHIR resources from directory"""
+
+    for input_file in _json_files(directory_path, pattern):
+        # base 0 line of an ndjson file, 0 for a json document
+        for offset, resource in enumerate(_read_json_file(input_file)):
+            parse_result = parse_obj(resource, validate)
+            parse_result.path = input_file
+            parse_result.offset = offset
+            for _ in _entry_iterator(parse_result):
+                yield _
@@ -0,0 +1,49 @@
+"""Test the postgres binary COPY encoding."""
+import struct
+from datetime import datetime, timedelta, timezone
+
+from aced_submission.meta_graph_load import _copy_binary_row, _pg_timestamp, EMPTY_JSONB, EMPTY_TEXT_ARRAY, \
+    PG_EPOCH, PGCOPY_HEADER, PGCOPY_TRAILER
+
+
+def test_copy_framing():
+    """Signature, flags and header extension length, then the -1 field count trailer."""
+    assert PGCOPY_HEADER == b'PGCOPY\n\xff\r\n\x00' + b'\x00\x00\x00\x00' + b'\x00\x00\x00\x00'
+    assert len(PGCOPY_HEADER) == 19
+    assert PGCOPY_TRAILER == b'\xff\xff'
+
+
+def test_pg_timestamp():
+    """Big endian int64 microseconds since 2000-01-01 UTC."""
+    assert _pg_timestamp(PG_EPOCH) == b'\x00' * 8
+    assert _pg_timestamp(PG_EPOCH + timedelta(seconds=1, microseconds=1)) == struct.pack('!q', 1000001)
+    assert _pg_timestamp(PG_EPOCH - timedelta(microseconds=1)) == b'\xff' * 8
+    # same instant in another time zone
+    other_tz = datetime(2000, 1, 1, 2, tzinfo=timezone(timedelta(hours=2)))
+    assert _pg_timestamp(other_tz) == b'\x00' * 8
+    assert _pg_timestamp(datetime(2023, 5, 17, 12, 30, tzinfo=timezone.utc)) == struct.pack('!q', 737641800000000)
+
+
+def test_empty_values():
+    """Empty text[] has zero dimensions, no null bitmap, element oid 25; jsonb is version 1 then text."""
+    assert EMPTY_TEXT_ARRAY == b'\x00\x00\x00\x00' + b'\x00\x00\x00\x00' + b'\x00\x00\x00\x19'
+    assert EMPTY_JSONB == b'\x01{}'
+
+
+def test_copy_binary_row():
+    """Int16 field count, then each field as an int32 length and its bytes."""
+    assert _copy_binary_row() == b'\x00\x00'
+    assert _copy_binary_row(b'') == b'\x00\x01' + b'\x00\x00\x00\x00'
+    assert _copy_binary_row(b'ab', b'xyz') == b'\x00\x02' + b'\x00\x00\x00\x02ab' + b'\x00\x00\x00\x03xyz'
+    # an edge row: src_id | dst_id | acl | _sysan | _props | created
+    row = _copy_binary_row(b'src', 'dst-é'.encode(), EMPTY_TEXT_ARRAY, EMPTY_JSONB, EMPTY_JSONB,
+                           _pg_timestamp(PG_EPOCH))
+    assert row == (
+        b'\x00\x06'
+        + b'\x00\x00\x00\x03src'
+        + b'\x00\x00\x00\x06dst-\xc3\xa9'
+        + b'\x00\x00\x00\x0c' + EMPTY_TEXT_ARRAY
+        + b'\x00\x00\x00\x03\x01{}'
+        + b'\x00\x00\x00\x03\x01{}'
+        + b'\x00\x00\x00\x08' + b'\x00' * 8
+    )
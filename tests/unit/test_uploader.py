@@ -0,0 +1,65 @@
+"""Test uploader helpers."""
+import hashlib
+import io
+
+import pytest
+
+from aced_submission.uploader import _already_uploaded, _HashingReader, _strip_url_prefixes
+
+
+@pytest.mark.parametrize("url,expected", [
+    ('file:///data/file.txt', 'data/file.txt'),
+    ('file://data/file.txt', 'data/file.txt'),
+    ('./data/file.txt', 'data/file.txt'),
+    ('/data/file.txt', 'data/file.txt'),
+    ('file:///./data/file.txt', 'data/file.txt'),
+    ('file.txt', 'file.txt'),
+    ('flow.txt', 'flow.txt'),
+    ('.hidden/file.txt', '.hidden/file.txt'),
+    ('../up/file.txt', '../up/file.txt'),
+    ('./.hidden', '.hidden'),
+])
+def test_strip_url_prefixes(url, expected):
+    """Only file:// schemes, './' and '/' are removed, dot files and parent paths are kept."""
+    assert _strip_url_prefixes(url) == expected
+
+
+def test_hashing_reader():
+    """Bytes read are hashed, len is the declared size so requests sends a Content-Length."""
+    data = bytes(range(256)) * 100
+    reader = _HashingReader(io.BytesIO(data), len(data))
+    assert len(reader) == len(data)
+    chunks = []
+    while True:
+        chunk = reader.read(1000)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    assert b''.join(chunks) == data
+    assert reader.tell() == len(data)
+    assert reader.md5.hexdigest() == hashlib.md5(data).hexdigest()
+
+
+def test_hashing_reader_seek():
+    """A retry rewinds the body, the digest starts over rather than hashing the bytes twice."""
+    data = b'0123456789'
+    reader = _HashingReader(io.BytesIO(data), len(data))
+    reader.read(4)
+    assert reader.seek(0) == 0
+    assert reader.read() == data
+    assert reader.md5.hexdigest() == hashlib.md5(data).hexdigest()
+
+
+def test_already_uploaded(tmp_path):
+    """Old summary lines and per upload lines are both read, failed uploads are retried."""
+    state_file = tmp_path / 'state.ndjson'
+    state_file.write_bytes(b'\n'.join([
+        # summary line written by earlier versions
+        b'{"completed": ["old-1", "old-2"], "incomplete": ["old-3"], "exceptions": {"old-3": {}}}',
+        b'{"id": "new-1", "ok": true, "timestamp": "2023-01-01T00:00:00"}',
+        b'{"id": "new-2", "ok": false, "timestamp": "2023-01-01T00:00:00", "exception": "boom"}',
+        # a failed upload that succeeded on a later run
+        b'{"id": "new-3", "ok": false, "timestamp": "2023-01-01T00:00:00", "exception": "boom"}',
+        b'{"id": "new-3", "ok": true, "timestamp": "2023-01-02T00:00:00"}',
+    ]) + b'\n')
+    assert _already_uploaded(state_file) == {'old-1', 'old-2', 'new-1', 'new-3'}
@@ -0,0 +1,67 @@
+"""Test util readers and iterators."""
+import threading
+
+import pytest
+
+from aced_submission.util import chunk, prefetch, read_ndjson
+
+
+def test_read_ndjson(tmp_path):
+    """One dict per line, with or without a trailing newline."""
+    path = tmp_path / 'with_newline.ndjson'
+    path.write_bytes(b'{"id": "1"}\n{"id": "2"}\n')
+    assert list(read_ndjson(path)) == [{'id': '1'}, {'id': '2'}]
+
+    path = tmp_path / 'without_newline.ndjson'
+    path.write_bytes(b'{"id": "1"}\n{"id": "2"}')
+    assert list(read_ndjson(path)) == [{'id': '1'}, {'id': '2'}]
+
+    path = tmp_path / 'single.ndjson'
+    path.write_bytes(b'{"id": "\xc3\xa9"}')
+    assert list(read_ndjson(path)) == [{'id': 'é'}]
+
+
+def test_read_ndjson_empty(tmp_path):
+    """Empty files can't be memory mapped, they yield nothing."""
+    path = tmp_path / 'empty.ndjson'
+    path.write_bytes(b'')
+    assert list(read_ndjson(path)) == []
+
+
+def test_chunk():
+    """Tuples of arr_size, the last one short."""
+    assert list(chunk(range(5), 2)) == [(0, 1), (2, 3), (4,)]
+    assert list(chunk([], 2)) == []
+
+
+def test_prefetch():
+    """Items arrive in order, through a queue smaller than the iterable."""
+    assert list(prefetch(range(100), maxsize=2)) == list(range(100))
+    assert list(prefetch([])) == []
+
+
+def test_prefetch_producer_exception():
+    """An exception raised by the iterable is raised to the consumer."""
+    def _failing():
+        yield 1
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError, match='boom'):
+        list(prefetch(_failing()))
+
+
+def test_prefetch_early_close():
+    """A consumer that stops early doesn't leave the producer blocked on a full queue."""
+    produced = []
+
+    def _items():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    threads = threading.active_count()
+    items = prefetch(_items(), maxsize=2)
+    assert next(items) == 0
+    items.close()
+    assert len(produced) < 1000
+    assert threading.active_count() == threads